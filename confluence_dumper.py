@@ -17,9 +17,12 @@ Confluence-dumper is a Python project to export spaces, pages and attachments
 from __future__ import print_function
 import sys
 import codecs
+import re
 
 import os
+import shelve
 import shutil
+from multiprocessing.pool import ThreadPool
 from lxml import html
 from lxml.etree import XMLSyntaxError
 
@@ -30,6 +33,68 @@ import settings
 CONFLUENCE_DUMPER_VERSION = '1.0.0'
 TITLE_OUTPUT = 'C O N F L U E N C E   D U M P E R  %s' % CONFLUENCE_DUMPER_VERSION
 
+# Paths of downloadable files and of image previews generated by Confluence (see derive_downloaded_file_name)
+DOWNLOAD_PATH = '/download/'
+GENERATED_PREVIEW_PATH = '/rest/documentConversion/latest/conversion/thumbnail/'
+
+# Maximum number of concurrent background requests (settings copied from older samples may not contain it yet)
+DOWNLOAD_CONCURRENCY = getattr(settings, 'DOWNLOAD_CONCURRENCY', 8)
+
+# One HTTP session for all requests to the Confluence server (keeps connections alive)
+HTTP_SESSION = utils.create_http_session(auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
+                                         verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
+                                         proxies=settings.HTTP_PROXIES, pool_size=DOWNLOAD_CONCURRENCY)
+
+# Threads which download the attachments of a page concurrently (and request upcoming pages in the background); the
+# threads are only started on first use (see get_download_pool)
+DOWNLOAD_POOL = None
+
+# Seconds to wait at most for a background task (a timeout keeps waiting interruptible via Ctrl-C on Python 2)
+BACKGROUND_TASK_TIMEOUT = 24 * 60 * 60
+
+# Number of upcoming pages which are requested in the background while the current page is exported
+PAGE_PREFETCH_COUNT = 4
+
+# A dict in the structure {'<download folder>': set of the file names in this folder} (see get_existing_downloads)
+EXISTING_DOWNLOADS = {}
+
+# Whether an existing export is updated instead of being replaced (settings copied from older samples may not contain
+# it yet)
+INCREMENTAL_EXPORT = getattr(settings, 'INCREMENTAL_EXPORT', False)
+
+# File in the export folder which keeps the page contents and attachment versions for incremental exports (see
+# provide_page_content and record_attachment_versions)
+PAGE_CACHE_FILE_NAME = '.page_cache'
+
+# Version of an attachment in its download URL (see download_attachment)
+ATTACHMENT_VERSION_PATTERN = re.compile(r'[?&]version=(\d+)')
+
+# File extensions of attachments for which Confluence generates thumbnails/image previews (as sets for fast lookups)
+THUMBNAIL_FORMATS = frozenset(settings.CONFLUENCE_THUMBNAIL_FORMATS)
+GENERATED_PREVIEW_FORMATS = frozenset(settings.CONFLUENCE_GENERATED_PREVIEW_FORMATS)
+
+# Fragments of all references which have to be replaced with local ones (see handle_html_references)
+REFERENCES_PATTERN = re.compile(r'/display/|/pages/viewpage\.action\?pageId=|confluence-embedded-file|%s|%s'
+                                % (re.escape(DOWNLOAD_PATH), re.escape(GENERATED_PREVIEW_PATH)))
+
+# Parser for page contents; references are only looked up by tag, so no id index has to be built
+# Note: Parsers must not be shared between threads, page contents are only handled by the main thread
+HTML_PARSER = html.HTMLParser(collect_ids=False)
+
+# Page id of links to other Confluence pages when page ids are used (without further GET parameters or anchors)
+PAGE_ID_PATTERN = re.compile(r'/pages/viewpage\.action\?pageId=(\w*)')
+
+
+class IndentationCache(dict):
+    """ Dict in the structure {<depth>: '<indentation>'} which creates missing indentations on demand """
+    def __missing__(self, depth):
+        indentation = self[depth] = '\t'*depth
+        return indentation
+
+
+# Indentations of console outputs per hierarchy depth
+INDENTATIONS = IndentationCache()
+
 
 def error_print(*args, **kwargs):
     """ Wrapper for the print function which leads to stderr outputs.
@@ -40,6 +105,7 @@ def error_print(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+@utils.memoize()
 def derive_downloaded_file_name(download_url):
     """ Generates the name of a downloaded/exported file.
 
@@ -47,25 +113,37 @@ def derive_downloaded_file_name(download_url):
             => <download_folder>/524291_attachments_peak.jpeg
         Example: /download/thumbnails/524291/Harvey.jpg?version=1&modificationDate=1459521827579&api=v2
             => <download_folder>/524291_thumbnails_Harvey.jpg
+        Example: https://cdn.example.com/download/logo.png
+            => None (not a Confluence download URL)
 
     :param download_url: Confluence download URL which is used to derive the downloaded file name.
     :returns: Derived file name; if derivation is not possible, None is returned.
     """
-    if '/download/' in download_url:
-        download_url_parts = download_url.split('/')
+    download_path_index = download_url.find(DOWNLOAD_PATH)
+    if download_path_index > 0:
+        # Ignore everything in front of the download path (e.g. the context path of the Confluence server)
+        download_url = download_url[download_path_index:]
+
+    if download_path_index != -1:
+        # Only the first five parts are used: ['', 'download', <type>, <page id>, <file name + GET parameters>]
+        download_url_parts = download_url.split('/', 5)
+        if len(download_url_parts) < 5:
+            return None
         download_page_id = download_url_parts[3]
         download_file_type = download_url_parts[2]
 
-        # Remove GET parameters
-        last_question_mark_index = download_url_parts[4].rfind('?')
-        download_original_file_name = download_url_parts[4][:last_question_mark_index]
+        # Remove GET parameters (the decoded file name itself may contain question marks)
+        download_original_file_name = download_url_parts[4]
+        if '?' in download_original_file_name:
+            download_original_file_name = download_original_file_name.rpartition('?')[0]
 
         return '%s_%s_%s' % (download_page_id, download_file_type, download_original_file_name)
-    elif '/rest/documentConversion/latest/conversion/thumbnail/' in download_url:
-        file_id = download_url.split('/rest/documentConversion/latest/conversion/thumbnail/')[1][0:-2]
+
+    preview_path_index = download_url.find(GENERATED_PREVIEW_PATH)
+    if preview_path_index != -1:
+        file_id = download_url[preview_path_index+len(GENERATED_PREVIEW_PATH):-2]
         return 'generated_preview_%s.jpg' % file_id
-    else:
-        return None
+    return None
 
 
 def provide_unique_file_name(duplicate_file_names, file_matching, file_title, is_folder=False,
@@ -79,9 +157,8 @@ def provide_unique_file_name(duplicate_file_names, file_matching, file_title, is
     :param is_folder: (optional) Flag which states whether the file is a folder
     :param explicit_file_extension: (optional) Explicitly set file extension (e.g. 'html')
     """
-    if file_title in file_matching:
-        file_name = file_matching[file_title]
-    else:
+    file_name = file_matching.get(file_title)
+    if file_name is None:
         file_name = utils.sanitize_for_filename(file_title)
 
         if is_folder:
@@ -89,8 +166,9 @@ def provide_unique_file_name(duplicate_file_names, file_matching, file_title, is
         elif explicit_file_extension:
             file_extension = explicit_file_extension
         else:
-            if '.' in file_name:
-                file_name, file_extension = file_name.rsplit('.', 1)
+            file_base_name, extension_separator, file_extension = file_name.rpartition('.')
+            if extension_separator:
+                file_name = file_base_name
             else:
                 file_extension = None
 
@@ -119,70 +197,115 @@ def handle_html_references(html_content, page_duplicate_file_names, page_file_ma
     """
     if html_content == "":
         return ""
+
+    # Pages without any reference to replace do not have to be parsed and serialized again
+    if not REFERENCES_PATTERN.search(html_content):
+        return html_content
+
     try:
-        html_tree = html.fromstring(html_content)
+        html_tree = html.fromstring(html_content, parser=HTML_PARSER)
     except XMLSyntaxError:
         print('%sWARNING: Could not parse HTML content of last page. Original content will be downloaded as it is.'
-              % ('\t'*(depth+1)))
+              % (INDENTATIONS[depth+1]))
         return html_content
 
-    # Fix links to other Confluence pages
-    # Example: /display/TES/pictest1
-    #       => pictest1.html
+    # Fix all references in one walk over the <a> and <img> elements; the handled references are:
+    #   1. links to other Confluence pages,
+    #      Example: /display/TES/pictest1
+    #            => pictest1.html
+    #   2. links to other Confluence pages when page ids are used,
+    #   3. attachment links,
+    #   4. file paths for img tags.
     # TODO: This code does not work for "Recent space activity" areas in space pages because of a different url format.
-    xpath_expr = '//a[contains(@href, "/display/")]'
-    for link_element in html_tree.xpath(xpath_expr):
-        if not link_element.get('class'):
-            print("LINK - "+link_element.attrib['href'])
+    # TODO: Handle non-<img> tags as well if necessary.
+    # TODO: Support files with different versions as well if necessary.
+    references_replaced = False
+    for element in html_tree.iter('a', 'img'):
+        if element.tag == 'img':
+            file_url = element.get('src')
+            if not file_url or (DOWNLOAD_PATH not in file_url and GENERATED_PREVIEW_PATH not in file_url):
+                continue
+
+            # Replace file path
+            file_name = derive_downloaded_file_name(file_url)
+            if file_name is None:
+                continue
+            relative_file_path = '%s/%s' % (settings.DOWNLOAD_SUB_FOLDER, file_name)
+            element.attrib['src'] = relative_file_path
+            references_replaced = True
+
+            # Add alt attribute if it does not exist yet
+            if not 'alt' in element.attrib.keys():
+                element.attrib['alt'] = relative_file_path
+            continue
+
+        link_url = element.get('href')
+        link_class = element.get('class')
+        if not link_url:
+            continue
+
+        if link_class:
+            if 'confluence-embedded-file' in link_class:
+                file_name = derive_downloaded_file_name(link_url)
+                if file_name is not None:
+                    relative_file_path = '%s/%s' % (settings.DOWNLOAD_SUB_FOLDER, file_name)
+                    #element.attrib['href'] = utils.encode_url(relative_file_path)
+                    element.attrib['href'] = relative_file_path
+                    references_replaced = True
+
+        elif '/display/' in link_url:
+            print("LINK - "+link_url)
             try:
-                page_title = link_element.attrib['href'].split('/')[4]
+                page_title = link_url.split('/')[4]
             except:
-                page_title = link_element.attrib['href'].split('/')[3]
+                page_title = link_url.split('/')[3]
 
             page_title = page_title.replace('+', ' ')
             decoded_page_title = utils.decode_url(page_title)
             offline_link = provide_unique_file_name(page_duplicate_file_names, page_file_matching, decoded_page_title,
                                                     explicit_file_extension='html')
-            link_element.attrib['href'] = utils.encode_url(offline_link)
+            element.attrib['href'] = utils.encode_url(offline_link)
+            references_replaced = True
 
-    # Fix links to other Confluence pages when page ids are used
-    xpath_expr = '//a[contains(@href, "/pages/viewpage.action?pageId=")]'
-    for link_element in html_tree.xpath(xpath_expr):
-        if not link_element.get('class'):
-            page_id = link_element.attrib['href'].split('/pages/viewpage.action?pageId=')[1]
+        elif '/pages/viewpage.action?pageId=' in link_url:
+            page_id = PAGE_ID_PATTERN.search(link_url).group(1)
             offline_link = '%s.html' % utils.sanitize_for_filename(page_id)
-            link_element.attrib['href'] = utils.encode_url(offline_link)
-
-    # Fix attachment links
-    xpath_expr = '//a[contains(@class, "confluence-embedded-file")]'
-    for link_element in html_tree.xpath(xpath_expr):
-        file_url = link_element.attrib['href']
-        file_name = derive_downloaded_file_name(file_url)
-        relative_file_path = '%s/%s' % (settings.DOWNLOAD_SUB_FOLDER, file_name)
-        #link_element.attrib['href'] = utils.encode_url(relative_file_path)
-        link_element.attrib['href'] = relative_file_path
-
-    # Fix file paths for img tags
-    # TODO: Handle non-<img> tags as well if necessary.
-    # TODO: Support files with different versions as well if necessary.
-    possible_image_xpaths = ['//img[contains(@src, "/download/")]',
-                             '//img[contains(@src, "/rest/documentConversion/latest/conversion/thumbnail/")]']
-    xpath_expr = '|'.join(possible_image_xpaths)
-    for img_element in html_tree.xpath(xpath_expr):
-        # Replace file path
-        file_url = img_element.attrib['src']
-        file_name = derive_downloaded_file_name(file_url)
-        relative_file_path = '%s/%s' % (settings.DOWNLOAD_SUB_FOLDER, file_name)
-        img_element.attrib['src'] = relative_file_path
+            element.attrib['href'] = utils.encode_url(offline_link)
+            references_replaced = True
 
-        # Add alt attribute if it does not exist yet
-        if not 'alt' in img_element.attrib.keys():
-            img_element.attrib['alt'] = relative_file_path
+    # Untouched pages are returned as they are instead of serializing the whole tree again
+    if not references_replaced:
+        return html_content
+    return html.tostring(html_tree, encoding='unicode')
 
-    return html.tostring(html_tree)
 
+def get_download_pool():
+    """ Provides the thread pool for concurrent downloads and starts it on first use.
 
-def download_file(clean_url, download_folder, downloaded_file_name, depth=0, error_output=True):
+    :returns: :class:`multiprocessing.pool.ThreadPool` with DOWNLOAD_CONCURRENCY threads.
+    """
+    global DOWNLOAD_POOL
+    if DOWNLOAD_POOL is None:
+        DOWNLOAD_POOL = ThreadPool(DOWNLOAD_CONCURRENCY)
+    return DOWNLOAD_POOL
+
+
+def get_existing_downloads(download_folder):
+    """ Provides the names of the files which already exist in a download folder. The folder is only listed once;
+    afterwards the set is kept up to date by download_file (which is the only one writing to this folder).
+
+    :param download_folder: Folder to place downloaded files in.
+    :returns: Set of file names.
+    """
+    existing_downloads = EXISTING_DOWNLOADS.get(download_folder)
+    if existing_downloads is None:
+        # Note: Listing a unicode path returns unicode file names, so they match non-ASCII attachment names
+        existing_downloads = EXISTING_DOWNLOADS.setdefault(download_folder, set(os.listdir(unicode(download_folder))))
+    return existing_downloads
+
+
+def download_file(clean_url, download_folder, downloaded_file_name, depth=0, error_output=True,
+                  replace_existing=False):
     """ Downloads a specific file.
 
     :param clean_url: Decoded URL to the file.
@@ -190,32 +313,53 @@ def download_file(clean_url, download_folder, downloaded_file_name, depth=0, err
     :param downloaded_file_name: File name to save the download to.
     :param depth: (optional) Hierarchy depth of the handled Confluence page.
     :param error_output: (optional) Set to False if you do not want to see any error outputs
+    :param replace_existing: (optional) Set to True to download the file even if it exists already (e.g. because it
+                             is outdated).
     :returns: Path to the downloaded file.
     """
-    downloaded_file_path = '%s/%s' % (download_folder, downloaded_file_name)
+    downloaded_file_path = os.path.join(download_folder, downloaded_file_name)
 
     # Download file if it does not exist yet
-    if not os.path.exists(downloaded_file_path):
+    existing_downloads = get_existing_downloads(download_folder)
+    if replace_existing:
+        existing_downloads.discard(downloaded_file_name)
+    if downloaded_file_name not in existing_downloads:
         absolute_download_url = '%s%s' % (settings.CONFLUENCE_BASE_URL, clean_url)
-        print('%sDOWNLOAD: %s' % ('\t'*(depth+1), downloaded_file_name))
+        print('%sDOWNLOAD: %s' % (INDENTATIONS[depth+1], downloaded_file_name))
         try:
-            utils.http_download_binary_file(absolute_download_url, downloaded_file_path,
-                                            auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
-                                            verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
-                                            proxies=settings.HTTP_PROXIES)
+            utils.http_download_binary_file(absolute_download_url, downloaded_file_path, HTTP_SESSION)
+            existing_downloads.add(downloaded_file_name)
 
         except utils.ConfluenceException as e:
             if error_output:
-                error_print('%sERROR: %s' % ('\t'*(depth+2), e))
+                error_print('%sERROR: %s' % (INDENTATIONS[depth+2], e))
             else:
-                print('%sWARNING: %s' % ('\t'*(depth+2), e))
+                print('%sWARNING: %s' % (INDENTATIONS[depth+2], e))
 
     return downloaded_file_path
 
 
+def start_download(clean_url, download_folder, downloaded_file_name, depth=0, error_output=True,
+                   replace_existing=False):
+    """ Starts downloading a specific file in the background (see download_file).
+
+    :param clean_url: Decoded URL to the file.
+    :param download_folder: Folder to place the downloaded file in.
+    :param downloaded_file_name: File name to save the download to.
+    :param depth: (optional) Hierarchy depth of the handled Confluence page.
+    :param error_output: (optional) Set to False if you do not want to see any error outputs
+    :param replace_existing: (optional) Set to True to download the file even if it exists already.
+    :returns: Pending download.
+    """
+    return get_download_pool().apply_async(download_file, (clean_url, download_folder, downloaded_file_name),
+                                           {'depth': depth, 'error_output': error_output,
+                                            'replace_existing': replace_existing})
+
+
 def download_attachment(download_url, download_folder, attachment_id, attachment_duplicate_file_names,
-                        attachment_file_matching, depth=0):
-    """ Repairs links in the page contents with local links.
+                        attachment_file_matching, depth=0, page_cache=None):
+    """ Downloads an attachment (with its thumbnail or image preview) in the background. The unique file names are
+    assigned right away, so they do not depend on the order in which the downloads finish.
 
     :param download_url: Confluence download URL.
     :param download_folder: Folder to place downloaded files in.
@@ -224,33 +368,73 @@ def download_attachment(download_url, download_folder, attachment_id, attachment
                                             duplicates}
     :param attachment_file_matching: A dict in the structure {'<attachment title>': '<used offline filename>'}
     :param depth: (optional) Hierarchy depth of the handled Confluence page.
-    :returns: Path and name of the downloaded file as dict.
+    :param page_cache: (optional) Cache of incremental exports which also keeps the versions of downloaded attachments
+                       (see record_attachment_versions).
+    :returns: Name, path, path relative to the exported pages and version of the downloaded file as dict and the
+              pending downloads as list.
     """
     clean_url = utils.decode_url(download_url)
     downloaded_file_name = derive_downloaded_file_name(clean_url)
     downloaded_file_name = provide_unique_file_name(attachment_duplicate_file_names, attachment_file_matching,
                                                     downloaded_file_name)
-    downloaded_file_path = download_file(download_url, download_folder, downloaded_file_name, depth=depth)
-
-    # Download the thumbnail as well if the attachment is an image
-    clean_thumbnail_url = clean_url.replace('/attachments/', '/thumbnails/', 1)
-    downloaded_thumbnail_file_name = derive_downloaded_file_name(clean_thumbnail_url)
-    downloaded_thumbnail_file_name = provide_unique_file_name(attachment_duplicate_file_names, attachment_file_matching,
-                                                              downloaded_thumbnail_file_name)
-    if utils.is_file_format(downloaded_thumbnail_file_name, settings.CONFLUENCE_THUMBNAIL_FORMATS):
+    downloaded_file_path = os.path.join(download_folder, downloaded_file_name)
+
+    # Attachments (with their thumbnails and previews) which changed since the previous export are downloaded again
+    attachment_version_match = ATTACHMENT_VERSION_PATTERN.search(download_url)
+    attachment_version = attachment_version_match.group(1) if attachment_version_match else None
+    is_outdated = page_cache is not None and \
+        page_cache.get(get_attachment_cache_key(downloaded_file_path)) != attachment_version
+
+    pending_downloads = [start_download(download_url, download_folder, downloaded_file_name, depth=depth,
+                                        replace_existing=is_outdated)]
+
+    # Download the thumbnail as well if the attachment is an image (the thumbnail keeps the file extension)
+    if utils.is_file_format(downloaded_file_name, THUMBNAIL_FORMATS):
+        clean_thumbnail_url = clean_url.replace('/attachments/', '/thumbnails/', 1)
+        downloaded_thumbnail_file_name = derive_downloaded_file_name(clean_thumbnail_url)
+        downloaded_thumbnail_file_name = provide_unique_file_name(attachment_duplicate_file_names,
+                                                                  attachment_file_matching,
+                                                                  downloaded_thumbnail_file_name)
         # TODO: Confluence creates thumbnails always as PNGs but does not change the file extension to .png.
-        download_file(clean_thumbnail_url, download_folder, downloaded_thumbnail_file_name, depth=depth,
-                      error_output=False)
+        pending_downloads.append(start_download(clean_thumbnail_url, download_folder, downloaded_thumbnail_file_name,
+                                                depth=depth, error_output=False, replace_existing=is_outdated))
 
     # Download the image preview as well if Confluence generated one for the attachment
-    if utils.is_file_format(downloaded_file_name, settings.CONFLUENCE_GENERATED_PREVIEW_FORMATS):
+    if utils.is_file_format(downloaded_file_name, GENERATED_PREVIEW_FORMATS):
         clean_preview_url = '/rest/documentConversion/latest/conversion/thumbnail/%s/1' % attachment_id
         downloaded_preview_file_name = derive_downloaded_file_name(clean_preview_url)
         downloaded_preview_file_name = provide_unique_file_name(attachment_duplicate_file_names,
                                                                 attachment_file_matching, downloaded_preview_file_name)
-        download_file(clean_preview_url, download_folder, downloaded_preview_file_name, depth=depth, error_output=False)
+        pending_downloads.append(start_download(clean_preview_url, download_folder, downloaded_preview_file_name,
+                                                depth=depth, error_output=False, replace_existing=is_outdated))
+
+    # The relative path links the file from exported pages (which are placed next to the download folder)
+    relative_file_path = '%s/%s' % (settings.DOWNLOAD_SUB_FOLDER, downloaded_file_name)
+    attachment_info = {'file_name': downloaded_file_name, 'file_path': downloaded_file_path,
+                       'relative_path': relative_file_path, 'version': attachment_version}
+    return attachment_info, pending_downloads
+
+
+def get_attachment_cache_key(downloaded_file_path):
+    """ Provides the key of the version of a downloaded attachment in the page cache.
+
+    :param downloaded_file_path: Path to the downloaded attachment.
+    :returns: Cache key.
+    """
+    return ('attachment:%s' % downloaded_file_path).encode('utf8')
 
-    return {'file_name': downloaded_file_name, 'file_path': downloaded_file_path}
+
+def record_attachment_versions(page_cache, download_folder, attachments):
+    """ Remembers the versions of all completely downloaded attachments for the next incremental export.
+
+    :param page_cache: Cache of incremental exports (see provide_page_content).
+    :param download_folder: Folder which contains the downloaded attachments.
+    :param attachments: List of attachments (as provided by download_attachment) whose downloads are finished.
+    """
+    existing_downloads = get_existing_downloads(download_folder)
+    for attachment in attachments:
+        if attachment['file_name'] in existing_downloads:
+            page_cache[get_attachment_cache_key(attachment['file_path'])] = attachment['version']
 
 
 def create_html_attachment_index(attachments):
@@ -259,53 +443,119 @@ def create_html_attachment_index(attachments):
     :param attachments: List of attachments.
     :returns: Attachment list as HTML.
     """
-    html_content = '\n\n<h2>Attachments</h2>'
+    html_parts = ['\n\n<h2>Attachments</h2>']
     if len(attachments) > 0:
-        html_content += '<ul>\n'
+        html_parts.append('<ul>\n')
         for attachment in attachments:
-            relative_file_path = '/'.join(attachment['file_path'].split('/')[2:])
-            relative_file_path = utils.encode_url(relative_file_path)
-            html_content += '\t<li><a href="%s">%s</a></li>\n' % (relative_file_path, attachment['file_name'])
-        html_content += '</ul>\n'
-    return html_content
+            relative_file_path = utils.encode_url(attachment['relative_path'])
+            html_parts.append('\t<li><a href="%s">%s</a></li>\n' % (relative_file_path, attachment['file_name']))
+        html_parts.append('</ul>\n')
+    return ''.join(html_parts)
+
+
+def request_page(page_id, include_content=True):
+    """ Requests a Confluence page with its version, child pages, attachments and (optionally) its content.
+
+    :param page_id: Confluence page id.
+    :param include_content: (optional) Set to False if the content is taken from the page cache (see
+                            provide_page_content).
+    :returns: JSON response of the page.
+    :raises: ConfluenceException in the case of the page could not be requested.
+    """
+    page_url = '%s/rest/api/content/%s?expand=version,children.page,children.attachment' \
+               % (settings.CONFLUENCE_BASE_URL, page_id)
+    if include_content:
+        page_url += ',body.view.value'
+    return utils.http_get(page_url, HTTP_SESSION)
 
 
-def fetch_page_recursively(page_id, folder_path, download_folder, html_template, depth=0,
-                           page_duplicate_file_names=None, page_file_matching=None,
-                           attachment_duplicate_file_names=None, attachment_file_matching=None):
-    """ Fetches a Confluence page and its child pages (with referenced downloads).
+def provide_page_content(page_cache, page_id, page_version):
+    """ Provides the content of a page from the page cache; it is only requested if the page changed since then.
+
+    :param page_cache: A dict-like cache in the structure {'<page id>': {'version': <page version>, 'content':
+                       '<page content>'}} (which also keeps the versions of downloaded attachments)
+    :param page_id: Confluence page id.
+    :param page_version: Current version number of the page.
+    :returns: Content of the page.
+    :raises: ConfluenceException in the case of the page content could not be requested.
+    """
+    cache_key = str(page_id)
+    cached_page = page_cache.get(cache_key)
+    if cached_page and cached_page['version'] == page_version:
+        return cached_page['content']
+
+    page_url = '%s/rest/api/content/%s?expand=body.view.value' % (settings.CONFLUENCE_BASE_URL, page_id)
+    page_content = utils.http_get(page_url, HTTP_SESSION)['body']['view']['value']
+    page_cache[cache_key] = {'version': page_version, 'content': page_content}
+    return page_content
+
+
+def iterate_children(page_id, child_type, children):
+    """ Iterates over all child pages or attachments of a Confluence page in batches. The next batch is requested in
+    the background while the current one is handled.
+
+    :param page_id: Confluence page id.
+    :param child_type: Type of the children ('page' or 'attachment').
+    :param children: First batch of children (as expanded in the page response).
+    :returns: Generator of lists of children.
+    :raises: ConfluenceException in the case of a batch could not be requested.
+    """
+    while children and children['results']:
+        next_children_url = None
+        if 'next' in children['_links']:
+            next_children_url = '%s%s' % (settings.CONFLUENCE_BASE_URL, children['_links']['next'])
+        elif children['size'] >= children['limit']:
+            # Expanded collections do not always contain a link to the next batch
+            next_children_url = '%s/rest/api/content/%s/child/%s?limit=200&start=%d' \
+                                % (settings.CONFLUENCE_BASE_URL, page_id, child_type,
+                                   children['start'] + children['size'])
+
+        next_children_request = None
+        if next_children_url:
+            next_children_request = get_download_pool().apply_async(utils.http_get, (next_children_url, HTTP_SESSION))
+
+        yield children['results']
+        children = next_children_request.get(BACKGROUND_TASK_TIMEOUT) if next_children_request else None
+
+
+def fetch_page(page_id, folder_path, download_folder, html_template, page_duplicate_file_names, page_file_matching,
+               depth=0, attachment_duplicate_file_names=None, attachment_file_matching=None, page_request=None,
+               page_cache=None):
+    """ Fetches a Confluence page (with referenced downloads) and the ids of its child pages.
 
     :param page_id: Confluence page id.
     :param folder_path: Folder to place downloaded pages in.
     :param download_folder: Folder to place downloaded files in.
     :param html_template: HTML template used to export Confluence pages.
-    :param depth: (optional) Hierarchy depth of the handled Confluence page.
     :param page_duplicate_file_names: A dict in the structure {'<sanitized page filename>': amount of duplicates}
     :param page_file_matching: A dict in the structure {'<page title>': '<used offline filename>'}
+    :param depth: (optional) Hierarchy depth of the handled Confluence page.
     :param attachment_duplicate_file_names: A dict in the structure {'<sanitized attachment filename>': amount of \
                                             duplicates}
     :param attachment_file_matching: A dict in the structure {'<attachment title>': '<used offline filename>'}
-    :returns: Information about downloaded files (pages, attachments, images, ...) as a dict (None for exceptions)
+    :param page_request: (optional) Pending background request of the page (see request_page).
+    :param page_cache: (optional) Cache of page contents for incremental exports (see provide_page_content).
+    :returns: Information about downloaded files (pages, attachments, images, ...) as a dict (None for exceptions) and
+              the ids of the child pages as a list
     """
-    if not page_duplicate_file_names:
-        page_duplicate_file_names = {}
-    if not page_file_matching:
-        page_file_matching = {}
-    if not attachment_duplicate_file_names:
+    if attachment_duplicate_file_names is None:
         attachment_duplicate_file_names = {}
-    if not attachment_file_matching:
+    if attachment_file_matching is None:
         attachment_file_matching = {}
 
-    page_url = '%s/rest/api/content/%s?expand=children.page,children.attachment,body.view.value' \
-               % (settings.CONFLUENCE_BASE_URL, page_id)
     try:
-        response = utils.http_get(page_url, auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
-                                  verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
-                                  proxies=settings.HTTP_PROXIES)
-        page_content = response['body']['view']['value']
+        if page_request:
+            response = page_request.get(BACKGROUND_TASK_TIMEOUT)
+        else:
+            response = request_page(page_id, page_cache is None)
+        if page_cache is None:
+            page_content = response['body']['view']['value']
+        else:
+            page_content = provide_page_content(page_cache, page_id, response['version']['number'])
+        page_children = response['children']
 
         page_title = response['title']
-        print('%sPAGE: %s (%s)' % ('\t'*(depth+1), page_title, page_id))
+        print('%sPAGE: %s (%s)' % (INDENTATIONS[depth+1], page_title, page_id))
 
         # Construct unique file name
         file_name = provide_unique_file_name(page_duplicate_file_names, page_file_matching, page_title,
@@ -314,38 +564,32 @@ def fetch_page_recursively(page_id, folder_path, download_folder, html_template,
         # Remember this file and all children
         path_collection = {'file_path': file_name, 'page_title': page_title, 'child_pages': [], 'child_attachments': []}
 
-        # Download attachments of this page
-        # TODO: Outsource/Abstract the following two while loops because of much duplicate code.
-        page_url = '%s/rest/api/content/%s/child/attachment?limit=25' % (settings.CONFLUENCE_BASE_URL, page_id)
-        counter = 0
-        while page_url:
-            response = utils.http_get(page_url, auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
-                                      verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
-                                      proxies=settings.HTTP_PROXIES)
-            counter += len(response['results'])
-            for attachment in response['results']:
-                download_url = attachment['_links']['download']
-                attachment_id = attachment['id'][3:]
-                attachment_info = download_attachment(download_url, download_folder, attachment_id,
-                                                      attachment_duplicate_file_names, attachment_file_matching,
-                                                      depth=depth+1)
+        # Download attachments of this page concurrently; file names are assigned here in the order of the attachments
+        # to keep them deterministic
+        # Note: The first attachments are part of the page response already, further ones are requested in batches
+        pending_downloads = []
+        for attachments in iterate_children(page_id, 'attachment', page_children['attachment']):
+            for attachment in attachments:
+                attachment_info, attachment_downloads = download_attachment(
+                    attachment['_links']['download'], download_folder, attachment['id'][3:],
+                    attachment_duplicate_file_names, attachment_file_matching, depth=depth+1, page_cache=page_cache)
                 path_collection['child_attachments'].append(attachment_info)
+                pending_downloads.extend(attachment_downloads)
 
-            if 'next' in response['_links'].keys():
-                page_url = response['_links']['next']
-                page_url = '%s%s' % (settings.CONFLUENCE_BASE_URL, page_url)
-            else:
-                page_url = None
+        for pending_download in pending_downloads:
+            pending_download.get(BACKGROUND_TASK_TIMEOUT)
+        if page_cache is not None:
+            record_attachment_versions(page_cache, download_folder, path_collection['child_attachments'])
 
         # Export HTML file
         page_content = handle_html_references(page_content, page_duplicate_file_names, page_file_matching,
                                               depth=depth+1)
-        file_path = '%s/%s' % (folder_path, file_name)
+        file_path = os.path.join(folder_path, file_name)
         page_content += create_html_attachment_index(path_collection['child_attachments'])
         utils.write_html_2_file(file_path, page_title, page_content, html_template)
 
         # Save another file with page id which forwards to the original one
-        id_file_path = '%s/%s.html' % (folder_path, page_id)
+        id_file_path = os.path.join(folder_path, '%s.html' % page_id)
         id_file_page_title = 'Forward to page %s' % page_title
         original_file_link = utils.encode_url(utils.sanitize_for_filename(file_name))
         id_file_page_content = settings.HTML_FORWARD_MESSAGE % (original_file_link, page_title)
@@ -353,31 +597,68 @@ def fetch_page_recursively(page_id, folder_path, download_folder, html_template,
         utils.write_html_2_file(id_file_path, id_file_page_title, id_file_page_content, html_template,
                                 additional_headers=[id_file_forward_header])
 
-        # Iterate through all child pages
-        page_url = '%s/rest/api/content/%s/child/page?limit=25' % (settings.CONFLUENCE_BASE_URL, page_id)
-        counter = 0
-        while page_url:
-            response = utils.http_get(page_url, auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
-                                      verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
-                                      proxies=settings.HTTP_PROXIES)
-            counter += len(response['results'])
-            for child_page in response['results']:
-                paths = fetch_page_recursively(child_page['id'], folder_path, download_folder, html_template,
-                                               depth=depth+1, page_duplicate_file_names=page_duplicate_file_names,
-                                               page_file_matching=page_file_matching)
-                if paths:
-                    path_collection['child_pages'].append(paths)
-
-            if 'next' in response['_links'].keys():
-                page_url = response['_links']['next']
-                page_url = '%s%s' % (settings.CONFLUENCE_BASE_URL, page_url)
-            else:
-                page_url = None
-        return path_collection
+        # Collect the ids of all child pages (the first ones are part of the page response as well)
+        child_page_ids = []
+        for child_pages in iterate_children(page_id, 'page', page_children['page']):
+            child_page_ids.extend(child_page['id'] for child_page in child_pages)
+        return path_collection, child_page_ids
 
     except utils.ConfluenceException as e:
-        error_print('%sERROR: %s' % ('\t'*(depth+1), e))
-        return None
+        error_print('%sERROR: %s' % (INDENTATIONS[depth+1], e))
+        return None, []
+
+
+def fetch_page_tree(root_page_id, folder_path, download_folder, html_template, page_cache=None):
+    """ Fetches a Confluence page and all of its descendant pages (with referenced downloads).
+
+    The page tree is walked depth-first with an explicit stack instead of recursive calls, so deeply nested spaces do
+    not run into the recursion limit.
+
+    :param root_page_id: Confluence page id of the topmost page (e.g. the home page of a space).
+    :param folder_path: Folder to place downloaded pages in.
+    :param download_folder: Folder to place downloaded files in.
+    :param html_template: HTML template used to export Confluence pages.
+    :param page_cache: (optional) Cache of page contents for incremental exports (see provide_page_content).
+    :returns: Information about downloaded files (pages, attachments, images, ...) as a dict which contains the
+              information about the child pages recursively (None for exceptions)
+    """
+    page_duplicate_file_names = {}
+    page_file_matching = {}
+    root_path_collection = None
+
+    # A dict in the structure {'<page id>': pending background request of the page}; page contents are only requested
+    # along with the page if they are not taken from the page cache
+    page_requests = {}
+    include_content = page_cache is None
+
+    # Pages to fetch in the structure (page id, depth, path collection of the parent page); the next page is on top
+    pending_pages = [(root_page_id, 0, None)]
+    while pending_pages:
+        # Request the next pages in the background; pages are still exported one after another to keep the assignment
+        # of unique file names deterministic
+        for upcoming_page_id, _, _ in pending_pages[-PAGE_PREFETCH_COUNT:]:
+            if upcoming_page_id not in page_requests:
+                page_requests[upcoming_page_id] = get_download_pool().apply_async(request_page,
+                                                                                  (upcoming_page_id, include_content))
+
+        page_id, depth, parent_path_collection = pending_pages.pop()
+        path_collection, child_page_ids = fetch_page(page_id, folder_path, download_folder, html_template,
+                                                     page_duplicate_file_names, page_file_matching, depth=depth,
+                                                     page_request=page_requests.pop(page_id, None),
+                                                     page_cache=page_cache)
+        if not path_collection:
+            continue
+
+        if parent_path_collection:
+            parent_path_collection['child_pages'].append(path_collection)
+        else:
+            root_path_collection = path_collection
+
+        # Push the child pages in reverse order to fetch them in their original order
+        for child_page_id in reversed(child_page_ids):
+            pending_pages.append((child_page_id, depth+1, path_collection))
+
+    return root_path_collection
 
 
 def create_html_index(index_content):
@@ -386,19 +667,27 @@ def create_html_index(index_content):
     :param index_content: Dictionary which contains file paths, page titles and their children recursively.
     :returns: Content index as HTML.
     """
-    file_path = utils.encode_url(index_content['file_path'])
-    page_title = index_content['page_title']
-    page_children = index_content['child_pages']
+    html_parts = []
+
+    # Explicit stack of index entries and closing markup (avoids recursion and repeated string concatenation)
+    pending_entries = [index_content]
+    while pending_entries:
+        entry = pending_entries.pop()
+        if isinstance(entry, basestring):
+            html_parts.append(entry)
+            continue
 
-    html_content = '<a href="%s">%s</a>' % (utils.sanitize_for_filename(file_path), page_title)
+        file_path = utils.encode_url(entry['file_path'])
+        html_parts.append('<a href="%s">%s</a>' % (utils.sanitize_for_filename(file_path), entry['page_title']))
 
-    if len(page_children) > 0:
-        html_content += '<ul>\n'
-        for child in page_children:
-            html_content += '\t<li>%s</li>\n' % create_html_index(child)
-        html_content += '</ul>\n'
+        page_children = entry['child_pages']
+        if len(page_children) > 0:
+            html_parts.append('<ul>\n')
+            pending_entries.append('</ul>\n')
+            for child in reversed(page_children):
+                pending_entries.extend(('</li>\n', child, '\t<li>'))
 
-    return html_content
+    return ''.join(html_parts)
 
 
 def print_welcome_output():
@@ -427,25 +716,24 @@ def main():
 
     # Welcome output
     print_welcome_output()
-    # Delete old export
-    if os.path.exists(settings.EXPORT_FOLDER):
+    # Delete old export (unless it is updated incrementally)
+    if os.path.exists(settings.EXPORT_FOLDER) and not INCREMENTAL_EXPORT:
         shutil.rmtree(settings.EXPORT_FOLDER)
-    os.makedirs(settings.EXPORT_FOLDER)
+    if not os.path.exists(settings.EXPORT_FOLDER):
+        os.makedirs(settings.EXPORT_FOLDER)
 
     # Read HTML template
-    template_file = open(settings.TEMPLATE_FILE)
-    html_template = template_file.read()
+    with codecs.open(settings.TEMPLATE_FILE, encoding='utf-8') as template_file:
+        html_template = utils.parse_html_template(template_file.read())
 
     # Fetch all spaces if spaces were not configured via settings
     if len(settings.SPACES_TO_EXPORT) > 0:
         spaces_to_export = settings.SPACES_TO_EXPORT
     else:
         spaces_to_export = []
-        page_url = '%s/rest/api/space?limit=25' % settings.CONFLUENCE_BASE_URL
+        page_url = '%s/rest/api/space?limit=200' % settings.CONFLUENCE_BASE_URL
         while page_url:
-            response = utils.http_get(page_url, auth=settings.HTTP_AUTHENTICATION, headers=settings.HTTP_CUSTOM_HEADERS,
-                                      verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
-                                      proxies=settings.HTTP_PROXIES)
+            response = utils.http_get(page_url, HTTP_SESSION)
             for space in response['results']:
                 spaces_to_export.append(space['key'])
 
@@ -457,48 +745,60 @@ def main():
 
     print('Exporting %d space(s): %s\n' % (len(spaces_to_export), ', '.join(spaces_to_export)))
 
-    # Export spaces
-    space_counter = 0
-    duplicate_space_names = {}
-    space_matching = {}
-    for space in spaces_to_export:
-        space_counter += 1
-
-        # Create folders for this space
-        space_folder_name = provide_unique_file_name(duplicate_space_names, space_matching, space, is_folder=True)
-        space_folder = '%s/%s' % (settings.EXPORT_FOLDER, space_folder_name)
-        try:
-            os.makedirs(space_folder)
-            download_folder = '%s/%s' % (space_folder, settings.DOWNLOAD_SUB_FOLDER)
-            os.makedirs(download_folder)
-
-            space_url = '%s/rest/api/space/%s?expand=homepage' % (settings.CONFLUENCE_BASE_URL, space)
-            response = utils.http_get(space_url, auth=settings.HTTP_AUTHENTICATION,
-                                      headers=settings.HTTP_CUSTOM_HEADERS,
-                                      verify_peer_certificate=settings.VERIFY_PEER_CERTIFICATE,
-                                      proxies=settings.HTTP_PROXIES)
-            space_name = response['name']
+    # Page contents of previous exports (only for incremental exports)
+    page_cache = None
+    if INCREMENTAL_EXPORT:
+        page_cache = shelve.open(os.path.join(settings.EXPORT_FOLDER, PAGE_CACHE_FILE_NAME))
 
-            print('SPACE (%d/%d): %s (%s)' % (space_counter, len(spaces_to_export), space_name, space))
-
-            if "homepage" in response.keys():
-                space_page_id = response['homepage']['id']
-            else:
-                space_page_id = -1
-
-            path_collection = fetch_page_recursively(space_page_id, space_folder, download_folder, html_template)
-
-            if path_collection:
-                # Create index file for this space
-                space_index_path = '%s/index.html' % space_folder
-                space_index_title = 'Index of Space %s (%s)' % (space_name, space)
-                space_index_content = create_html_index(path_collection)
-                utils.write_html_2_file(space_index_path, space_index_title, space_index_content, html_template)
-        except utils.ConfluenceException as e:
-            error_print('ERROR: %s' % e)
-        except OSError:
-            print('WARNING: The space %s has been exported already. Maybe you mentioned it twice in the settings'
-                  % space)
+    try:
+        # Export spaces
+        space_counter = 0
+        duplicate_space_names = {}
+        space_matching = {}
+        for space in spaces_to_export:
+            space_counter += 1
+
+            # Spaces which are mentioned twice have got their folder assigned already
+            if space in space_matching:
+                print('WARNING: The space %s has been exported already. Maybe you mentioned it twice in the settings'
+                      % space)
+                continue
+
+            # Create folders for this space
+            space_folder_name = provide_unique_file_name(duplicate_space_names, space_matching, space, is_folder=True)
+            space_folder = os.path.join(settings.EXPORT_FOLDER, space_folder_name)
+            try:
+                download_folder = os.path.join(space_folder, settings.DOWNLOAD_SUB_FOLDER)
+                if not os.path.isdir(download_folder):
+                    os.makedirs(download_folder)
+
+                space_url = '%s/rest/api/space/%s?expand=homepage' % (settings.CONFLUENCE_BASE_URL, space)
+                response = utils.http_get(space_url, HTTP_SESSION)
+                space_name = response['name']
+
+                print('SPACE (%d/%d): %s (%s)' % (space_counter, len(spaces_to_export), space_name, space))
+
+                if "homepage" in response.keys():
+                    space_page_id = response['homepage']['id']
+                else:
+                    space_page_id = -1
+
+                path_collection = fetch_page_tree(space_page_id, space_folder, download_folder, html_template,
+                                                  page_cache=page_cache)
+
+                if path_collection:
+                    # Create index file for this space
+                    space_index_path = os.path.join(space_folder, 'index.html')
+                    space_index_title = 'Index of Space %s (%s)' % (space_name, space)
+                    space_index_content = create_html_index(path_collection)
+                    utils.write_html_2_file(space_index_path, space_index_title, space_index_content, html_template)
+            except utils.ConfluenceException as e:
+                error_print('ERROR: %s' % e)
+            except OSError as e:
+                error_print('ERROR: %s' % e)
+    finally:
+        if page_cache is not None:
+            page_cache.close()
 
     # Finished output
     print_finished_output()
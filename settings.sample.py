@@ -31,11 +31,22 @@ HTTP_PROXIES = {}
 # Example for custom authentication: {'user': 'johndoe', 'password': 'sup3rs3cur3pw'}
 HTTP_CUSTOM_HEADERS = None
 
+# Maximum number of concurrent background requests (attachment downloads and upcoming pages and child batches), also
+# the size of the HTTP connection pool
+DOWNLOAD_CONCURRENCY = 8
+
 # Export specific settings
 EXPORT_FOLDER = 'export'
 DOWNLOAD_SUB_FOLDER = 'attachments'
 TEMPLATE_FILE = 'template.html'
 
+# Keep the previous export and only request the contents of pages which changed since then
+# Note: Unchanged attachments are kept, attachments with a new version are downloaded again (including their thumbnails
+# and previews). Pages which were removed from Confluence are not removed from the export.
+# Note: The rendered content of a page is only requested again when the page version changes, so macro outputs which
+# change without a new page version (e.g. child page lists or included pages) are kept as cached.
+INCREMENTAL_EXPORT = False
+
 # Confluence generates thumbnails for the following image formats
 CONFLUENCE_THUMBNAIL_FORMATS = ['gif', 'jpeg', 'jpg', 'png']
 
@@ -10,10 +10,37 @@
 # This work is licensed under the terms of the MIT license.
 # See the LICENSE.md file in the top-level directory.
 
+import functools
+import os
 import requests
 import shutil
 import re
+import string
 import urllib
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+try:
+    # Optional: Faster decoding of JSON responses (falls back to the JSON decoder of requests)
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# Size of the chunks in which downloaded files are written to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Seconds to wait for establishing a connection and for the next bytes of a response (requests has no default timeout)
+HTTP_TIMEOUT = (10, 60)
+
+# Characters which are not allowed in filenames on most filesystems and their replacement (see sanitize_for_filename)
+FILENAME_FORBIDDEN_CHARACTERS = '\\/:*?"<>|'
+FILENAME_TRANSLATION_TABLE = string.maketrans(FILENAME_FORBIDDEN_CHARACTERS, '_' * len(FILENAME_FORBIDDEN_CHARACTERS))
+UNICODE_FILENAME_TRANSLATION_TABLE = dict((ord(character), u'_') for character in FILENAME_FORBIDDEN_CHARACTERS)
+
+
+# Placeholders which are replaced in HTML templates (see parse_html_template)
+TEMPLATE_PLACEHOLDER_PATTERN = re.compile(r'{%\s*(title|content|additional_headers)\s*%\}', re.IGNORECASE)
 
 
 class ConfluenceException(Exception):
@@ -22,102 +49,188 @@ class ConfluenceException(Exception):
         super(ConfluenceException, self).__init__(message)
 
 
-def http_get(request_url, auth=None, headers=None, verify_peer_certificate=True, proxies=None):
-    """ Requests a HTTP url and returns a requested JSON response.
+def memoize(max_size=4096):
+    """ Decorator which caches the results of a function with hashable positional arguments.
+
+    The cache is emptied completely as soon as it would exceed ``max_size`` entries.
+
+    :param max_size: (optional) Maximum amount of cached results.
+    :returns: Decorator for the function to memoize.
+    """
+    def decorator(function):
+        cache = {}
+
+        @functools.wraps(function)
+        def memoized_function(*args):
+            try:
+                return cache[args]
+            except KeyError:
+                if len(cache) >= max_size:
+                    cache.clear()
+                result = cache[args] = function(*args)
+                return result
+
+        memoized_function.cache = cache
+        return memoized_function
+    return decorator
+
+
+def create_http_session(auth=None, headers=None, verify_peer_certificate=True, proxies=None, pool_size=10,
+                        max_retries=3):
+    """ Creates a HTTP session which keeps connections alive and reuses them for subsequent requests. The given
+    request options are applied to every request of this session.
 
-    :param request_url: HTTP URL to request.
     :param auth: (optional) Auth tuple to use HTTP Auth (supported: Basic/Digest/Custom).
-    :param headers: (optional) Dictionary of HTTP Headers to send with the :class:`Request`.
+    :param headers: (optional) Dictionary of HTTP Headers to send with every :class:`Request`.
     :param verify_peer_certificate: (optional) Flag to decide whether peer certificate has to be validated.
     :param proxies: (optional) Dictionary mapping protocol to the URL of the proxy.
+    :param pool_size: (optional) Maximum number of connections kept open per host.
+    :param max_retries: (optional) Number of retries for failed connections (with an increasing back-off delay).
+    :returns: :class:`requests.Session` to pass to :func:`http_get` or :func:`http_download_binary_file`.
+    """
+    session = requests.Session()
+    session.auth = auth
+    if headers:
+        session.headers.update(headers)
+
+    # Note: requests prefers environment variables (e.g. REQUESTS_CA_BUNDLE, HTTPS_PROXY) over the session's verify and
+    # proxies settings, so they are passed to each request again (see http_get and http_download_binary_file)
+    session.verify = verify_peer_certificate
+    if proxies:
+        session.proxies.update(proxies)
+
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          max_retries=Retry(total=max_retries, backoff_factor=0.3))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def http_get(request_url, session):
+    """ Requests a HTTP url and returns a requested JSON response.
+
+    :param request_url: HTTP URL to request.
+    :param session: :class:`requests.Session` to send the request with (see :func:`create_http_session`).
     :returns: JSON response.
-    :raises: ConfluenceException in the case of the server does not answer HTTP code 200.
+    :raises: ConfluenceException in the case of the server does not answer HTTP code 200 (or in time).
     """
-    response = requests.get(request_url, auth=auth, headers=headers, verify=verify_peer_certificate, proxies=proxies)
+    try:
+        response = session.get(request_url, verify=session.verify, proxies=session.proxies, timeout=HTTP_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise ConfluenceException('Error on requesting %s: %s' % (request_url, e))
     if 200 == response.status_code:
-        return response.json()
+        return ujson.loads(response.content) if ujson else response.json()
     else:
         raise ConfluenceException('Error %s: %s on requesting %s' % (response.status_code, response.reason,
                                                                      request_url))
 
 
-def http_download_binary_file(request_url, file_path, auth=None, headers=None, verify_peer_certificate=True,
-                              proxies=None):
+def http_download_binary_file(request_url, file_path, session):
     """ Requests a HTTP url to save a file on the local filesystem.
 
     :param request_url: Requested HTTP URL.
     :param file_path: Local file path.
-    :param auth: (optional) Auth tuple to use HTTP Auth (supported: Basic/Digest/Custom).
-    :param headers: (optional) Dictionary of HTTP Headers to send with the :class:`Request`.
-    :param verify_peer_certificate: (optional) Flag to decide whether peer certificate has to be validated.
-    :param proxies: (optional) Dictionary mapping protocol to the URL of the proxy.
-    :raises: ConfluenceException in the case of the server does not answer with HTTP code 200.
+    :param session: :class:`requests.Session` to send the request with (see :func:`create_http_session`).
+    :raises: ConfluenceException in the case of the server does not answer with HTTP code 200 (or in time) or the
+             file could not be saved completely.
     """
-    response = requests.get(request_url, stream=True, auth=auth, headers=headers, verify=verify_peer_certificate,
-                            proxies=proxies)
-    if 200 == response.status_code:
-        with open(file_path, 'wb') as downloaded_file:
-            response.raw.decode_content = True
+    try:
+        response = session.get(request_url, stream=True, verify=session.verify, proxies=session.proxies,
+                               timeout=HTTP_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise ConfluenceException('Error on requesting %s: %s' % (request_url, e))
+    try:
+        if 200 == response.status_code:
+            # Download into a temporary file first, so an incomplete download never ends up under the final file name
+            # Note: Downloaded file names never start with a dot, so the hidden temporary file cannot collide with them
+            folder_path, file_name = os.path.split(file_path)
+            temporary_file_path = os.path.join(folder_path, '.%s.download' % file_name)
             try:
-                shutil.copyfileobj(response.raw, downloaded_file)
-            except:
-                downloaded_file.write("could not copy file")
-    else:
-        raise ConfluenceException('Error %s: %s on requesting %s' % (response.status_code, response.reason,
-                                                                     request_url))
+                with open(temporary_file_path, 'wb') as downloaded_file:
+                    response.raw.decode_content = True
+                    # Fail on connections closed early instead of silently keeping a truncated file
+                    response.raw.enforce_content_length = True
+                    shutil.copyfileobj(response.raw, downloaded_file, DOWNLOAD_CHUNK_SIZE)
+                try:
+                    os.rename(temporary_file_path, file_path)
+                except OSError:
+                    # Windows does not replace existing files on rename
+                    os.remove(file_path)
+                    os.rename(temporary_file_path, file_path)
+            except Exception as e:
+                if os.path.exists(temporary_file_path):
+                    os.remove(temporary_file_path)
+                raise ConfluenceException('Error %s: Cannot save %s to %s' % (e, request_url, file_path))
+        else:
+            raise ConfluenceException('Error %s: %s on requesting %s' % (response.status_code, response.reason,
+                                                                         request_url))
+    finally:
+        # Hand the connection back to the session's pool
+        response.close()
 
 
 def write_2_file(path, content):
     """ Writes a string to a file.
 
     :param path: Local file path.
-    :param content: String content to persist.
+    :param content: String content to persist (or a list of strings which are written one after another).
     """
+    if isinstance(content, basestring):
+        content = [content]
     try:
         with open(path, 'w') as the_file:
-            the_file.write(content.encode('utf8'))
+            the_file.writelines(content_part.encode('utf8') for content_part in content)
     except:
         print("File could not be written")
 
+
+def parse_html_template(html_template):
+    """ Splits a HTML template into literal text and placeholders, so it can be filled without searching it again.
+
+    :param html_template: page template; supported placeholders: ``{% title %}``, ``{% content %}``,
+                          ``{% additional_headers %}``
+    :returns: List which alternates between literal text and placeholder names (to pass to write_html_2_file).
+    """
+    template_parts = TEMPLATE_PLACEHOLDER_PATTERN.split(html_template)
+    template_parts[1::2] = [placeholder.lower() for placeholder in template_parts[1::2]]
+    return template_parts
+
+
 def write_html_2_file(path, title, content, html_template, additional_headers=None):
     """ Writes HTML content to a file using a template.
 
     :param path: Local file path
     :param title: page title
     :param content: page content
-    :param html_template: page template; supported placeholders: ``{% title %}``, ``{% content %}``
+    :param html_template: page template as returned by parse_html_template
     :param additional_headers: (optional) Additional HTML headers.
     """
-    html_content = html_template
-
     # Build additional HTML headers
     additional_html_headers = '\n\t'.join(additional_headers) if additional_headers else ''
 
-    # Replace placeholders
-    # Note: One backslash has to be escaped with two avoid that backslashes are interpreted as escape chars
+    # Replace placeholders (every odd part of the template is a placeholder name)
     replacements = {'title': title, 'content': content, 'additional_headers': additional_html_headers}
+    html_parts = list(html_template)
+    html_parts[1::2] = [replacements[placeholder] for placeholder in html_template[1::2]]
 
-    for placeholder, replacement in replacements.iteritems():
-        regex_placeholder = r'{%\s*' + placeholder + r'\s*%\}'
-        try:
-            html_content = re.sub(regex_placeholder, replacement.replace('\\', '\\\\'), html_content,
-                                  flags=re.IGNORECASE)
-        except Exception as e:
-            raise ConfluenceException('Error %s: Cannot replace placeholders in template file.' % e)
-
-    write_2_file(path, html_content)
+    # Write the parts one after another instead of joining them to another copy of the whole page first
+    write_2_file(path, html_parts)
 
 
+@memoize(max_size=8192)
 def sanitize_for_filename(original_string):
     """ Sanitizes a string to use it as a filename on most filesystems.
 
     :param original_string: Original string to sanitize
     :returns: Sanitized string/filename
     """
-    sanitized_file_name = re.sub('[\\\\/:*?\"<>|]', '_', original_string)
-    return sanitized_file_name
+    if isinstance(original_string, unicode):
+        return original_string.translate(UNICODE_FILENAME_TRANSLATION_TABLE)
+    else:
+        return original_string.translate(FILENAME_TRANSLATION_TABLE)
 
 
+@memoize(max_size=8192)
 def decode_url(encoded_url):
     """ Unquotes and decodes a given URL.
 
@@ -133,15 +246,15 @@ def encode_url(decoded_url):
     :param decoded_url: Decoded URL.
     :returns: Encoded URL.
     """
-    return urllib.quote(decoded_url.encode('utf8')).encode('utf8')
+    return urllib.quote(decoded_url.encode('utf8'))
 
 
 def is_file_format(file_name, file_extensions):
     """ Checks whether the extension of the given file is in a list of file extensions.
 
     :param file_name: Filename to check
-    :param file_extensions: File extensions as a list
-    :returns: True if the list contains the extension of the given file_name
+    :param file_extensions: File extensions as a list (or preferably as a set)
+    :returns: True if the file extensions contain the extension of the given file_name
     """
-    file_extension = file_name.split('.')[-1]
+    file_extension = file_name.rpartition('.')[2]
     return file_extension in file_extensions